@@ -7,13 +7,18 @@ TODO:
 """
 
 import abc
+import hashlib
+import io
+import multiprocessing
+import os
 import shutil
 import struct
+import subprocess
+import sys
 import traceback
 from pathlib import Path
 from typing import Iterable, List, Union
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor
 
 import fire
 import numpy as np
@@ -23,6 +28,41 @@ from loguru import logger
 from qlib.utils import fname_to_code, code_to_fname, get_period_offset
 from qlib.config import C
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _build_next(periods: np.ndarray) -> np.ndarray:
+    """for each row, the index of the next row with the same period (-1 if none)"""
+    next_idx = np.full(len(periods), -1, dtype=np.int64)
+    last_pos = {}
+    for i in range(len(periods) - 1, -1, -1):
+        period = periods[i]
+        if period in last_pos:
+            next_idx[i] = last_pos[period]
+        last_pos[period] = i
+    return next_idx
+
+
+if njit is not None:
+    _build_next = njit(cache=True)(_build_next)
+
+
+_WORKER_DUMPER = None
+
+
+def _init_worker(dumper: "DumpPitData"):
+    # ship the dumper state to each worker once at pool startup instead of
+    # pickling it along with every submitted task
+    global _WORKER_DUMPER
+    _WORKER_DUMPER = dumper
+
+
+def _dump_pit_batch_worker(file_paths: List[Path], interval: str, overwrite: bool):
+    _WORKER_DUMPER._dump_pit_batch(file_paths, interval=interval, overwrite=overwrite)
+
 
 class DumpPitData:
     PIT_DIR_NAME = "financial"
@@ -53,6 +93,10 @@ class DumpPitData:
     UPDATE_MODE = "update"
     ALL_MODE = "all"
 
+    # csv files above this size are streamed in chunks to bound the parser's peak memory
+    LARGE_CSV_BYTES = 200 * 1024**2
+    READ_CSV_CHUNKSIZE = 1_000_000
+
     def __init__(
         self,
         csv_path: str,
@@ -101,11 +145,21 @@ class DumpPitData:
             include_fields = include_fields.split(",")
         self._exclude_fields = tuple(filter(lambda x: len(x) > 0, map(str.strip, exclude_fields)))
         self._include_fields = tuple(filter(lambda x: len(x) > 0, map(str.strip, include_fields)))
+        # build the filter arrays once here; get_dump_fields runs per batch in every worker
+        self._exclude_fields_arr = np.asarray(self._exclude_fields)
+        self._include_fields_arr = np.asarray(self._include_fields)
         self.file_suffix = file_suffix
-        self.csv_files = sorted(csv_path.glob(f"*{self.file_suffix}") if csv_path.is_dir() else [csv_path])
+        # iterdir + endswith avoids glob's per-entry fnmatch on large directories;
+        # dotfiles are skipped to keep glob's matching semantics
+        self.csv_files = sorted(
+            (p for p in csv_path.iterdir() if p.name.endswith(self.file_suffix) and not p.name.startswith("."))
+            if csv_path.is_dir()
+            else [csv_path]
+        )
         if limit_nums is not None:
             self.csv_files = self.csv_files[: int(limit_nums)]
         self.qlib_dir = Path(qlib_dir).expanduser()
+        self.cache_dir = self.qlib_dir.joinpath("_pit_cache")
         self.backup_dir = backup_dir if backup_dir is None else Path(backup_dir).expanduser()
         if backup_dir is not None:
             self._backup_qlib_dir(Path(backup_dir).expanduser())
@@ -119,26 +173,93 @@ class DumpPitData:
         self._mode = self.ALL_MODE
 
     def _backup_qlib_dir(self, target_dir: Path):
-        shutil.copytree(str(self.qlib_dir.resolve()), str(target_dir.resolve()))
-
-    def get_source_data(self, file_path: Path) -> pd.DataFrame:
-        df = pd.read_csv(str(file_path.resolve()), low_memory=False)
-        df[self.value_column_name] = df[self.value_column_name].astype("float32")
-        df[self.date_column_name] = df[self.date_column_name].str.replace("-", "").astype("int32")
+        src, dst = str(self.qlib_dir.resolve()), str(target_dir.resolve())
+        # keep copytree's contract: never merge into or clobber an existing target
+        if target_dir.exists():
+            raise FileExistsError(dst)
+        # a reflink snapshot shares extents copy-on-write where the filesystem supports
+        # it (btrfs/xfs) and silently degrades to a plain copy elsewhere; NOTE: hardlinks
+        # are not an option because dump() appends to the backed-up files in place.
+        # cp fills a temp sibling that is renamed into place, so a mid-copy failure
+        # never leaves (or removes) anything at the target path itself
+        if sys.platform == "linux":
+            tmp_dir = target_dir.with_name(f"{target_dir.name}.tmp-{os.getpid()}")
+            try:
+                subprocess.run(["cp", "-a", "--reflink=auto", src, str(tmp_dir)], check=True)
+                tmp_dir.rename(target_dir)
+                return
+            except (OSError, subprocess.CalledProcessError):
+                shutil.rmtree(str(tmp_dir), ignore_errors=True)
+        shutil.copytree(src, dst)
+
+    def get_source_data(self, file_path: Path, buf: bytes = None) -> pd.DataFrame:
+        _dtype = {
+            self.date_column_name: str,
+            self.period_column_name: "int32",
+            self.value_column_name: "float32",
+            self.field_column_name: str,
+        }
+        _usecols = list(_dtype)
+        # re-runs shortcut csv parsing through a columnar cache of the typed frame;
+        # the entry name binds the resolved source path and its exact (mtime, size),
+        # so a relocated, replaced or mtime-preserving update can never match stale data
+        _stat = file_path.stat()
+        _path_key = hashlib.md5(str(file_path.resolve()).encode()).hexdigest()[:16]
+        _cache_prefix = f"{file_path.stem}.{_path_key}"
+        cache_path = self.cache_dir.joinpath(f"{_cache_prefix}.{_stat.st_mtime_ns}-{_stat.st_size}.parquet")
+        if cache_path.exists():
+            try:
+                return pd.read_parquet(cache_path)
+            except (ImportError, OSError, ValueError):
+                # no parquet engine, or a corrupt/truncated entry: fall through and reparse
+                pass
+        _source = io.BytesIO(buf) if buf is not None else str(file_path.resolve())
+        _source_size = len(buf) if buf is not None else file_path.stat().st_size
+        try:
+            # the multithreaded arrow reader skips per-column type inference entirely
+            df = pd.read_csv(_source, dtype=_dtype, usecols=_usecols, engine="pyarrow")
+        except (ImportError, ValueError):
+            # pyarrow not installed or pandas too old for the pyarrow engine; with an
+            # explicit dtype there is no inference to buffer for, so low_memory is moot
+            if buf is not None:
+                _source.seek(0)
+            if _source_size > self.LARGE_CSV_BYTES:
+                _chunks = pd.read_csv(_source, dtype=_dtype, usecols=_usecols, chunksize=self.READ_CSV_CHUNKSIZE)
+                df = pd.concat(_chunks, ignore_index=True)
+            else:
+                df = pd.read_csv(_source, dtype=_dtype, usecols=_usecols)
+        # group/compare on small integer codes instead of python strings
+        df[self.field_column_name] = df[self.field_column_name].astype("category")
+        # dates repeat heavily across fields, so convert each distinct date string once and map
+        date_map = {_date: int(_date.replace("-", "")) for _date in df[self.date_column_name].unique()}
+        df[self.date_column_name] = df[self.date_column_name].map(date_map).astype("int32")
         # df.drop_duplicates([self.date_field_name], inplace=True)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for _stale in self.cache_dir.glob(f"{_cache_prefix}.*.parquet"):
+                _stale.unlink()
+            # write-then-rename so a killed worker never leaves a partial entry
+            # at the path later runs will read
+            _tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            df.to_parquet(_tmp_path, compression="zstd")
+            os.replace(_tmp_path, cache_path)
+        except (ImportError, ValueError, OSError):
+            # caching is best-effort: no parquet engine (pyarrow) or no zstd support
+            pass
         return df
 
     def get_symbol_from_file(self, file_path: Path) -> str:
         return fname_to_code(file_path.name[: -len(self.file_suffix)].strip().lower())
 
     def get_dump_fields(self, df: Iterable[str]) -> Iterable[str]:
-        return (
-            set(self._include_fields)
-            if self._include_fields
-            else set(df[self.field_column_name]) - set(self._exclude_fields)
-            if self._exclude_fields
-            else set(df[self.field_column_name])
-        )
+        # the field column is categorical, so its categories already enumerate the
+        # distinct fields without re-hashing every row
+        fields = np.asarray(df[self.field_column_name].cat.categories)
+        if self._include_fields:
+            fields = np.intersect1d(fields, self._include_fields_arr)
+        elif self._exclude_fields:
+            fields = np.setdiff1d(fields, self._exclude_fields_arr)
+        return fields
 
     def get_filenames(self, symbol, field, interval):
         dir_name = self.qlib_dir.joinpath(self.PIT_DIR_NAME, symbol)
@@ -154,6 +275,112 @@ class DumpPitData:
         interval: str = "quarterly",
         overwrite: bool = False,
     ):
+        """dump a single csv file; see `_dump_pit_batch` for the data layout"""
+        self._dump_pit_batch([Path(file_path)], interval=interval, overwrite=overwrite)
+
+    def _write_field(
+        self,
+        symbol: str,
+        field: str,
+        interval: str,
+        overwrite: bool,
+        dates: np.ndarray,
+        periods: np.ndarray,
+        values: np.ndarray,
+    ):
+        """write one field's date-sorted (date, period, value) arrays to its `.data`/`.index` pair"""
+        data_file, index_file = self.get_filenames(symbol, field, interval)
+
+        ## calculate first & last period
+        start_year = int(periods.min())
+        end_year = int(periods.max())
+        if interval == self.INTERVAL_quarterly:
+            start_year //= 100
+            end_year //= 100
+
+        # adjust `first_year` if existing data found
+        if not overwrite and index_file.exists():
+            with open(index_file, "rb") as fi:
+                (first_year,) = struct.unpack(self.PERIOD_DTYPE, fi.read(self.PERIOD_DTYPE_SIZE))
+                n_years = len(fi.read()) // self.INDEX_DTYPE_SIZE
+                if interval == self.INTERVAL_quarterly:
+                    n_years //= 4
+                start_year = first_year + n_years
+        else:
+            with open(index_file, "wb") as f:
+                f.write(struct.pack(self.PERIOD_DTYPE, start_year))
+            first_year = start_year
+
+        # if data already exists, continue to the next field
+        if start_year > end_year:
+            logger.warning(f"{symbol}-{field} data already exists, continue to the next field")
+            return
+
+        # dump index filled with NA
+        with open(index_file, "ab") as fi:
+            for year in range(start_year, end_year + 1):
+                if interval == self.INTERVAL_quarterly:
+                    fi.write(struct.pack(self.INDEX_DTYPE * 4, *[self.NA_INDEX] * 4))
+                else:
+                    fi.write(struct.pack(self.INDEX_DTYPE, self.NA_INDEX))
+
+        # if data already exists, remove overlapped data
+        if not overwrite and data_file.exists():
+            with open(data_file, "rb") as fd:
+                fd.seek(-self.DATA_DTYPE_SIZE, 2)
+                last_date, _, _, _ = struct.unpack(self.DATA_DTYPE, fd.read())
+            # dates are sorted, so the overlap is a prefix
+            _new = np.searchsorted(dates, last_date, side="right")
+            dates, periods, values = dates[_new:], periods[_new:], values[_new:]
+        # otherwise,
+        # 1) truncate existing file or create a new file with `wb+` if overwrite,
+        # 2) or append existing file or create a new file with `ab+` if not overwrite
+        else:
+            with open(data_file, "wb+" if overwrite else "ab+"):
+                pass
+
+        # records are laid out sequentially, so for in-batch period revisions the
+        # `_next` pointer is already known before the record is written; only the
+        # first occurrence of each period still has to consult the index file or
+        # walk a pre-existing on-disk chain
+        next_idx = _build_next(periods)
+        next_ptrs = np.where(next_idx >= 0, next_idx * self.DATA_DTYPE_SIZE, self.NA_INDEX)
+        is_first = np.ones(len(periods), dtype=bool)
+        is_first[next_idx[next_idx >= 0]] = False
+
+        with open(data_file, "rb+") as fd, open(index_file, "rb+") as fi:
+
+            # update index if needed
+            for date, period, value, next_ptr, first in zip(
+                dates.tolist(), periods.tolist(), values.tolist(), next_ptrs.tolist(), is_first.tolist()
+            ):
+                if first:
+                    # get index
+                    offset = get_period_offset(first_year, period, interval == self.INTERVAL_quarterly)
+
+                    fi.seek(self.PERIOD_DTYPE_SIZE + self.INDEX_DTYPE_SIZE * offset)
+                    (cur_index,) = struct.unpack(self.INDEX_DTYPE, fi.read(self.INDEX_DTYPE_SIZE))
+
+                    # Case I: new data => update `_next` with current index
+                    if cur_index == self.NA_INDEX:
+                        fi.seek(self.PERIOD_DTYPE_SIZE + self.INDEX_DTYPE_SIZE * offset)
+                        fi.write(struct.pack(self.INDEX_DTYPE, fd.tell()))
+                    # Case II: previous data exists => find and update the last `_next`
+                    else:
+                        _cur_fd = fd.tell()
+                        prev_index = self.NA_INDEX
+                        while cur_index != self.NA_INDEX:  # NOTE: first iter always != NA_INDEX
+                            fd.seek(cur_index + self.DATA_DTYPE_SIZE - self.INDEX_DTYPE_SIZE)
+                            prev_index = cur_index
+                            (cur_index,) = struct.unpack(self.INDEX_DTYPE, fd.read(self.INDEX_DTYPE_SIZE))
+                        fd.seek(prev_index + self.DATA_DTYPE_SIZE - self.INDEX_DTYPE_SIZE)
+                        fd.write(struct.pack(self.INDEX_DTYPE, _cur_fd))  # NOTE: add _next pointer
+                        fd.seek(_cur_fd)
+
+                # dump data
+                fd.write(struct.pack(self.DATA_DTYPE, date, period, value, next_ptr))
+
+    def _dump_pit_batch(self, file_paths: List[Path], interval: str = "quarterly", overwrite: bool = False):
         """
         dump data as the following format:
             `/path/to/<field>.data`
@@ -171,108 +398,99 @@ class DumpPitData:
 
         Parameters
         ----------
-        symbol: str
-            stock symbol
+        file_paths: List[Path]
+            csv files of this shard, one per symbol
         interval: str
             data interval
         overwrite: bool
             whether overwrite existing data or update only
         """
-        symbol = self.get_symbol_from_file(file_path)
-        df = self.get_source_data(file_path)
-        if df.empty:
-            logger.warning(f"{symbol} file is empty")
+        symbols = []
+        frames = []
+        # one-deep prefetch: a helper thread reads file k+1 from disk while the
+        # worker parses file k, hiding one read latency per file
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_future = None
+            for i, file_path in enumerate(file_paths):
+                buf = file_path.read_bytes() if next_future is None else next_future.result()
+                if i + 1 < len(file_paths):
+                    next_future = prefetcher.submit(Path.read_bytes, file_paths[i + 1])
+                symbol = self.get_symbol_from_file(file_path)
+                df = self.get_source_data(file_path, buf=buf)
+                if df.empty:
+                    logger.warning(f"{symbol} file is empty")
+                    continue
+                symbols.append(symbol)
+                frames.append(df)
+        if not frames:
             return
-        for field in self.get_dump_fields(df):
-            df_sub = df.query(f'{self.field_column_name}=="{field}"').sort_values(self.date_column_name)
-            if df_sub.empty:
-                logger.warning(f"field {field} of {symbol} is empty")
-                continue
-            data_file, index_file = self.get_filenames(symbol, field, interval)
-
-            ## calculate first & last period
-            start_year = df_sub[self.period_column_name].min()
-            end_year = df_sub[self.period_column_name].max()
-            if interval == self.INTERVAL_quarterly:
-                start_year //= 100
-                end_year //= 100
-
-            # adjust `first_year` if existing data found
-            if not overwrite and index_file.exists():
-                with open(index_file, "rb") as fi:
-                    (first_year,) = struct.unpack(self.PERIOD_DTYPE, fi.read(self.PERIOD_DTYPE_SIZE))
-                    n_years = len(fi.read()) // self.INDEX_DTYPE_SIZE
-                    if interval == self.INTERVAL_quarterly:
-                        n_years //= 4
-                    start_year = first_year + n_years
-            else:
-                with open(index_file, "wb") as f:
-                    f.write(struct.pack(self.PERIOD_DTYPE, start_year))
-                first_year = start_year
 
-            # if data already exists, continue to the next field
-            if start_year > end_year:
-                logger.warning(f"{symbol}-{field} data already exists, continue to the next field")
+        # process the whole shard in one sort/split pass: pandas' per-frame fixed
+        # costs (concat, categorize, column extraction) are paid once per batch
+        df = pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0]
+        df[self.field_column_name] = df[self.field_column_name].astype("category")
+        symbol_codes = np.repeat(np.arange(len(frames)), [len(_frame) for _frame in frames])
+        field_codes = df[self.field_column_name].cat.codes.to_numpy()
+        # hand the write loop plain column arrays; the per-field slices below are views
+        dates = df[self.date_column_name].to_numpy()
+        periods = df[self.period_column_name].to_numpy()
+        # values stay float32 until they are packed: financial PIT data carries few
+        # significant digits, and halving the column halves the bytes moved per pass
+        # (the on-disk record keeps the float64 layout pinned by C.pit_record_type)
+        values = df[self.value_column_name].to_numpy().astype(np.float32, copy=False)
+        # sources are often already stored grouped by field and date-sorted; detect
+        # the ordered case with one vectorized scan and skip the sort/gather passes
+        _d_field = np.diff(field_codes)
+        _sorted = (_d_field > 0) | ((_d_field == 0) & (np.diff(dates) >= 0))
+        if not np.all(_sorted | (np.diff(symbol_codes) != 0)):
+            order = np.lexsort((dates, field_codes, symbol_codes))
+            symbol_codes = symbol_codes[order]
+            field_codes = field_codes[order]
+            dates = dates[order]
+            periods = periods[order]
+            values = values[order]
+        # contiguous runs of identical (symbol, field) codes delimit the slices
+        bounds = np.flatnonzero((np.diff(symbol_codes) != 0) | (np.diff(field_codes) != 0)) + 1
+        categories = df[self.field_column_name].cat.categories
+        dump_fields = frozenset(self.get_dump_fields(df))
+        n_rows = len(df)
+        # only the extracted arrays are needed from here on; drop the per-file frames
+        # and the concatenated frame before the write loop to cut peak worker memory
+        del df, frames
+        for start, stop in zip(np.insert(bounds, 0, 0), np.append(bounds, n_rows)):
+            field = categories[field_codes[start]]
+            if field not in dump_fields:
                 continue
-
-            # dump index filled with NA
-            with open(index_file, "ab") as fi:
-                for year in range(start_year, end_year + 1):
-                    if interval == self.INTERVAL_quarterly:
-                        fi.write(struct.pack(self.INDEX_DTYPE * 4, *[self.NA_INDEX] * 4))
-                    else:
-                        fi.write(struct.pack(self.INDEX_DTYPE, self.NA_INDEX))
-
-            # if data already exists, remove overlapped data
-            if not overwrite and data_file.exists():
-                with open(data_file, "rb") as fd:
-                    fd.seek(-self.DATA_DTYPE_SIZE, 2)
-                    last_date, _, _, _ = struct.unpack(self.DATA_DTYPE, fd.read())
-                df_sub = df_sub.query(f"{self.date_column_name}>{last_date}")
-            # otherwise,
-            # 1) truncate existing file or create a new file with `wb+` if overwrite,
-            # 2) or append existing file or create a new file with `ab+` if not overwrite
-            else:
-                with open(data_file, "wb+" if overwrite else "ab+"):
-                    pass
-
-            with open(data_file, "rb+") as fd, open(index_file, "rb+") as fi:
-
-                # update index if needed
-                for i, row in df_sub.iterrows():
-                    # get index
-                    offset = get_period_offset(first_year, row.period, interval == self.INTERVAL_quarterly)
-
-                    fi.seek(self.PERIOD_DTYPE_SIZE + self.INDEX_DTYPE_SIZE * offset)
-                    (cur_index,) = struct.unpack(self.INDEX_DTYPE, fi.read(self.INDEX_DTYPE_SIZE))
-
-                    # Case I: new data => update `_next` with current index
-                    if cur_index == self.NA_INDEX:
-                        fi.seek(self.PERIOD_DTYPE_SIZE + self.INDEX_DTYPE_SIZE * offset)
-                        fi.write(struct.pack(self.INDEX_DTYPE, fd.tell()))
-                    # Case II: previous data exists => find and update the last `_next`
-                    else:
-                        _cur_fd = fd.tell()
-                        prev_index = self.NA_INDEX
-                        while cur_index != self.NA_INDEX:  # NOTE: first iter always != NA_INDEX
-                            fd.seek(cur_index + self.DATA_DTYPE_SIZE - self.INDEX_DTYPE_SIZE)
-                            prev_index = cur_index
-                            (cur_index,) = struct.unpack(self.INDEX_DTYPE, fd.read(self.INDEX_DTYPE_SIZE))
-                        fd.seek(prev_index + self.DATA_DTYPE_SIZE - self.INDEX_DTYPE_SIZE)
-                        fd.write(struct.pack(self.INDEX_DTYPE, _cur_fd))  # NOTE: add _next pointer
-                        fd.seek(_cur_fd)
-
-                    # dump data
-                    fd.write(struct.pack(self.DATA_DTYPE, row.date, row.period, row.value, self.NA_INDEX))
+            self._write_field(
+                symbols[symbol_codes[start]],
+                field,
+                interval,
+                overwrite,
+                dates[start:stop],
+                periods[start:stop],
+                values[start:stop],
+            )
 
     def dump(self, interval="quarterly", overwrite=False):
         logger.info("start dump pit data......")
-        _dump_func = partial(self._dump_pit, interval=interval, overwrite=overwrite)
-
+        # contiguous multi-file shards per task amortize the pool's pickle/queue
+        # roundtrip and give each worker a lookahead window for prefetching
+        n_batches = min(len(self.csv_files), self.works * 4)
+        batches = [list(_batch) for _batch in np.array_split(self.csv_files, n_batches)] if n_batches else []
+        # fork (linux) lets workers inherit the dumper state through copy-on-write
+        # pages instead of re-importing the world and unpickling it per process
+        _mp_context = multiprocessing.get_context("fork") if sys.platform == "linux" else None
         with tqdm(total=len(self.csv_files)) as p_bar:
-            with ProcessPoolExecutor(max_workers=self.works) as executor:
-                for _ in executor.map(_dump_func, self.csv_files):
-                    p_bar.update()
+            with ProcessPoolExecutor(
+                max_workers=self.works, mp_context=_mp_context, initializer=_init_worker, initargs=(self,)
+            ) as executor:
+                futures = {
+                    executor.submit(_dump_pit_batch_worker, _batch, interval, overwrite): len(_batch)
+                    for _batch in batches
+                }
+                for future in as_completed(futures):
+                    future.result()
+                    p_bar.update(futures[future])
 
     def __call__(self, *args, **kwargs):
         self.dump()